@@ -1,12 +1,54 @@
-import { spawn } from 'child_process';
+import { spawn, type ChildProcess } from 'child_process';
 import Replicate from 'replicate';
+import os from 'os';
 import path from 'path';
+import readline from 'readline';
 import { promises as fsPromises } from 'fs';
 
 const replicate = new Replicate({
   auth: process.env.REPLICATE_API_TOKEN,
 });
 
+// Several workers so concurrent fallback requests still run in parallel
+const OPENCV_WORKER_POOL_SIZE = Math.max(1, Math.min(4, os.cpus().length));
+
+// OPENCV_NUM_THREADS for each worker. This only sizes OpenCV's pool for the
+// GrabCut/compute stage: in --serve mode decoding and PNG encoding run on
+// their own threads alongside it, so one core of each worker's share is
+// left for them. Workers can still briefly exceed cpus / pool size
+const OPENCV_WORKER_THREADS = Math.max(1, Math.floor(os.cpus().length / OPENCV_WORKER_POOL_SIZE) - 1);
+
+// Restart each OpenCV worker periodically so leaks in native code can't accumulate
+const OPENCV_WORKER_MAX_JOBS = 100;
+
+// A worker that returns no result for this long is treated as hung: its
+// current job fails and the worker is killed
+const OPENCV_JOB_TIMEOUT_MS = 120000;
+
+// Jobs in flight per worker; further requests wait in opencvJobQueue so a
+// slow worker never has a long backlog behind it
+const OPENCV_WORKER_MAX_PENDING = 2;
+
+type OpenCVJobResult = {success: boolean; error?: string};
+
+interface OpenCVJob {
+  id: number;
+  inputPath: string;
+  outputPath: string;
+  resolve: (result: OpenCVJobResult) => void;
+}
+
+interface OpenCVWorker {
+  process: ChildProcess;
+  jobs: number;
+  pending: Map<number, OpenCVJob>;
+  watchdog: ReturnType<typeof setTimeout> | null;
+}
+
+const opencvWorkers: OpenCVWorker[] = [];
+const opencvJobQueue: OpenCVJob[] = [];
+let opencvJobCounter = 0;
+
 export interface BackgroundRemovalResult {
   success: boolean;
   cleanedImagePath?: string;
@@ -198,51 +240,206 @@ async function tryReplicateBackgroundRemoval(
   }
 }
 
+/**
+ * Start a persistent OpenCV worker so the Python interpreter and cv2 import
+ * are paid once instead of on every fallback call
+ */
+function startOpenCVWorker(): OpenCVWorker {
+  const pythonScript = path.join(process.cwd(), 'server/opencv-fallback.py');
+  console.log(`🐍 [OPENCV-BG] Starting persistent worker: ${pythonScript}`);
+  
+  const child = spawn('python3', [pythonScript, '--serve'], {
+    stdio: ['pipe', 'pipe', 'pipe'],
+    env: {
+      ...process.env,
+      OPENCV_NUM_THREADS: process.env.OPENCV_NUM_THREADS || String(OPENCV_WORKER_THREADS)
+    }
+  });
+  const worker: OpenCVWorker = { process: child, jobs: 0, pending: new Map(), watchdog: null };
+  
+  const failPending = (error: string) => {
+    clearOpenCVWatchdog(worker);
+    const jobs = Array.from(worker.pending.values());
+    worker.pending.clear();
+    removeOpenCVWorker(worker);
+    for (const job of jobs) {
+      job.resolve({ success: false, error });
+    }
+    // Queued jobs can now go to a replacement worker
+    dispatchOpenCVJobs();
+  };
+  
+  // Each stdout line is the JSON result for one job
+  readline.createInterface({ input: child.stdout! }).on('line', (line) => {
+    let message: any;
+    try {
+      message = JSON.parse(line);
+    } catch {
+      message = null;
+    }
+    
+    if (!message || typeof message !== 'object') {
+      console.log(`🐍 [OPENCV-BG] ${line}`);
+      return;
+    }
+    
+    const job = worker.pending.get(message.id);
+    if (job) {
+      worker.pending.delete(message.id);
+      // The worker made progress; restart the watchdog for the next job
+      armOpenCVWatchdog(worker);
+      job.resolve(message.success
+        ? { success: true }
+        : { success: false, error: message.error || 'OpenCV worker reported failure' });
+      dispatchOpenCVJobs();
+    }
+  });
+  
+  // Worker progress logging arrives on stderr
+  readline.createInterface({ input: child.stderr! }).on('line', (line) => {
+    console.log(`🐍 [OPENCV-BG] ${line}`);
+  });
+  
+  child.stdin!.on('error', (error) => {
+    console.error(`🐍 [OPENCV-BG] Worker stdin error:`, error);
+    failPending(error.message);
+  });
+  
+  child.on('close', (code) => {
+    console.log(`🐍 [OPENCV-BG] Worker exited with code: ${code}`);
+    failPending(`OpenCV worker exited with code ${code}`);
+  });
+  
+  child.on('error', (error) => {
+    console.error(`🐍 [OPENCV-BG] Worker process error:`, error);
+    failPending(error.message);
+  });
+  
+  return worker;
+}
+
+/**
+ * Take a worker out of the pool so no new jobs are sent to it
+ */
+function removeOpenCVWorker(worker: OpenCVWorker): void {
+  const index = opencvWorkers.indexOf(worker);
+  if (index !== -1) {
+    opencvWorkers.splice(index, 1);
+  }
+}
+
+function clearOpenCVWatchdog(worker: OpenCVWorker): void {
+  if (worker.watchdog) {
+    clearTimeout(worker.watchdog);
+    worker.watchdog = null;
+  }
+}
+
+/**
+ * (Re)start the worker's watchdog. Results come back in submission order, so
+ * the oldest pending job is the one being processed; if no result arrives
+ * for OPENCV_JOB_TIMEOUT_MS that job is failed and the worker killed. Jobs
+ * queued behind it are handed back to the dispatch queue rather than failed.
+ */
+function armOpenCVWatchdog(worker: OpenCVWorker): void {
+  clearOpenCVWatchdog(worker);
+  if (worker.pending.size === 0) {
+    return;
+  }
+  
+  worker.watchdog = setTimeout(() => {
+    worker.watchdog = null;
+    const [hungJob, ...waitingJobs] = Array.from(worker.pending.values());
+    worker.pending.clear();
+    removeOpenCVWorker(worker);
+    
+    console.error(`⏱️ [OPENCV-BG] Job ${hungJob.id} timed out after ${OPENCV_JOB_TIMEOUT_MS}ms, killing worker`);
+    worker.process.kill('SIGKILL');
+    hungJob.resolve({ success: false, error: `OpenCV job timed out after ${OPENCV_JOB_TIMEOUT_MS}ms` });
+    
+    opencvJobQueue.unshift(...waitingJobs);
+    dispatchOpenCVJobs();
+  }, OPENCV_JOB_TIMEOUT_MS);
+}
+
+/**
+ * Pick an OpenCV worker: an idle one if available, otherwise a new one while
+ * the pool has room, otherwise the least busy one below
+ * OPENCV_WORKER_MAX_PENDING. Returns null when every worker is full.
+ * Workers are recycled after OPENCV_WORKER_MAX_JOBS
+ */
+function getOpenCVWorker(): OpenCVWorker | null {
+  for (const worker of opencvWorkers.slice()) {
+    if (worker.jobs >= OPENCV_WORKER_MAX_JOBS) {
+      console.log(`♻️ [OPENCV-BG] Recycling worker after ${worker.jobs} jobs`);
+      removeOpenCVWorker(worker);
+      // Closing stdin lets the worker finish queued jobs and exit on its own
+      worker.process.stdin!.end();
+    }
+  }
+  
+  const idleWorker = opencvWorkers.find((worker) => worker.pending.size === 0);
+  if (idleWorker) {
+    return idleWorker;
+  }
+  
+  if (opencvWorkers.length < OPENCV_WORKER_POOL_SIZE) {
+    const worker = startOpenCVWorker();
+    opencvWorkers.push(worker);
+    return worker;
+  }
+  
+  const available = opencvWorkers.filter((worker) => worker.pending.size < OPENCV_WORKER_MAX_PENDING);
+  if (available.length === 0) {
+    return null;
+  }
+  
+  return available.reduce((least, worker) =>
+    worker.pending.size < least.pending.size ? worker : least
+  );
+}
+
+/**
+ * Send queued jobs to workers until the queue is empty or every worker is full
+ */
+function dispatchOpenCVJobs(): void {
+  while (opencvJobQueue.length > 0) {
+    const worker = getOpenCVWorker();
+    if (!worker) {
+      return;
+    }
+    
+    const job = opencvJobQueue.shift()!;
+    console.log(`🐍 [OPENCV-BG] Submitting job ${job.id} to worker`);
+    
+    worker.jobs++;
+    worker.pending.set(job.id, job);
+    if (worker.pending.size === 1) {
+      armOpenCVWatchdog(worker);
+    }
+    worker.process.stdin!.write(JSON.stringify({
+      id: job.id,
+      input_path: job.inputPath,
+      output_path: job.outputPath
+    }) + '\n');
+  }
+}
+
 /**
  * Try OpenCV background removal as fallback
  */
 async function tryOpenCVBackgroundRemoval(
   inputPath: string,
   outputPath: string
-): Promise<{success: boolean; error?: string}> {
+): Promise<OpenCVJobResult> {
   return new Promise((resolve) => {
-    const pythonScript = path.join(process.cwd(), 'server/opencv-fallback.py');
+    const id = ++opencvJobCounter;
     
-    console.log(`🐍 [OPENCV-BG] Executing Python script: ${pythonScript}`);
+    console.log(`🐍 [OPENCV-BG] Queueing job ${id}`);
     console.log(`📥 [OPENCV-BG] Input: ${inputPath}`);
     console.log(`📤 [OPENCV-BG] Output: ${outputPath}`);
     
-    const pythonProcess = spawn('python3', [pythonScript, inputPath, outputPath], {
-      stdio: ['pipe', 'pipe', 'pipe']
-    });
-    
-    let stdout = '';
-    let stderr = '';
-    
-    pythonProcess.stdout.on('data', (data) => {
-      stdout += data.toString();
-      console.log(`🐍 [OPENCV-BG] ${data.toString().trim()}`);
-    });
-    
-    pythonProcess.stderr.on('data', (data) => {
-      stderr += data.toString();
-      console.error(`🐍 [OPENCV-BG] Error: ${data.toString().trim()}`);
-    });
-    
-    pythonProcess.on('close', (code) => {
-      console.log(`🐍 [OPENCV-BG] Process completed with code: ${code}`);
-      
-      if (code === 0 && stdout.includes('SUCCESS')) {
-        resolve({ success: true });
-      } else {
-        const error = stderr || `Process exited with code ${code}`;
-        resolve({ success: false, error });
-      }
-    });
-    
-    pythonProcess.on('error', (error) => {
-      console.error(`🐍 [OPENCV-BG] Process error:`, error);
-      resolve({ success: false, error: error.message });
-    });
+    opencvJobQueue.push({ id, inputPath, outputPath, resolve });
+    dispatchOpenCVJobs();
   });
 }
\ No newline at end of file